@@ -1,71 +1,141 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+import io
 import os
-import requests
+import sys
 from dotenv import load_dotenv
 from datetime import date, datetime
 from enum import Enum
+from typing import NamedTuple, Optional
 from google import genai
 from google.genai import types
-import multiprocessing
+import httpx
 import time
 import re
+import string
 import pathlib
-import json
+import orjson
 import functools
-
-
-try:
-    multiprocessing.set_start_method('spawn', force=True)
-except RuntimeError:
-    pass
+import threading
+import queue
+import random
+import atexit
+import llm_cache
+import semantic_cache
 
 BASE_DIR = pathlib.Path(__file__).parent / "prompts"
 
 _INITIAL_GEN_TEMPLATE_PATH = BASE_DIR / "generate_initial_prompt.txt"
 _COMPARISON_TEMPLATE_PATH = BASE_DIR / "generate_comparison_prompt.txt"
-_CRITIQUE_TEMPLATE_PATH = BASE_DIR / "generate_critique_prompt.txt"
-_EDIT_TEMPLATE_PATH = BASE_DIR / "generate_edit_prompt.txt"
+_ALL_TOPICS_TEMPLATE_PATH = BASE_DIR / "generate_all_topics_prompt.txt"
+_CRITIQUE_AND_EDIT_TEMPLATE_PATH = BASE_DIR / "generate_critique_and_edit_prompt.txt"
+
+# Templates keep their static instructions first and the per-call fields
+# (date, company, topic) at the end, so Gemini's implicit prefix caching can
+# reuse the shared prefix across calls.
+_TRAILING_SPACE_RE = re.compile(r"[ \t]+$", re.MULTILINE)
 
+def _read_template(path: pathlib.Path) -> str:
+    """
+    Reads a prompt template with canonical whitespace (Unix line endings, no trailing
+    spaces), so an editor's whitespace changes never alter the bytes sent to the model.
+    """
+    return _TRAILING_SPACE_RE.sub("", path.read_text(encoding="utf-8"))
 
-_INITIAL_GEN_TEMPLATE = _INITIAL_GEN_TEMPLATE_PATH.read_text(encoding="utf-8")
-_COMPARISON_TEMPLATE = _COMPARISON_TEMPLATE_PATH.read_text(encoding="utf-8")
-_CRITIQUE_TEMPLATE = _CRITIQUE_TEMPLATE_PATH.read_text(encoding="utf-8")
-_EDIT_TEMPLATE = _EDIT_TEMPLATE_PATH.read_text(encoding="utf-8")
+_INITIAL_GEN_TEMPLATE = _read_template(_INITIAL_GEN_TEMPLATE_PATH)
+_COMPARISON_TEMPLATE = _read_template(_COMPARISON_TEMPLATE_PATH)
+_ALL_TOPICS_TEMPLATE = _read_template(_ALL_TOPICS_TEMPLATE_PATH)
+_CRITIQUE_AND_EDIT_TEMPLATE = _read_template(_CRITIQUE_AND_EDIT_TEMPLATE_PATH)
 
-today = date.today()
+def _split_template(template: str) -> list:
+    """Parses a str.format template once into (literal, field name or None) chunks."""
+    return [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
+
+def _render(chunks: list, **fields) -> str:
+    """Fills a split template; same output as str.format without re-parsing the template."""
+    return "".join(literal + (str(fields[field]) if field is not None else "") for literal, field in chunks)
+
+_INITIAL_GEN_CHUNKS = _split_template(_INITIAL_GEN_TEMPLATE)
+_COMPARISON_CHUNKS = _split_template(_COMPARISON_TEMPLATE)
+_ALL_TOPICS_CHUNKS = _split_template(_ALL_TOPICS_TEMPLATE)
+_CRITIQUE_AND_EDIT_CHUNKS = _split_template(_CRITIQUE_AND_EDIT_TEMPLATE)
 
 LLM_LOG_FILE = "llm_calls.log"
 
-numOfRetries = 0
+# Worker threads hand log entries to a single writer thread instead of touching the file
+_llm_log_queue = queue.Queue()
+
+# Upper bound on concurrent LLM calls; each topic is an independent chain of calls
+MAX_WORKERS = 16
 
-def retry_on_json_error(max_retries=1000, delay_seconds=1):
+# Companies analysed at once when several are entered together
+MAX_CONCURRENT_COMPANIES = 3
+
+# Requests per minute allowed by the Gemini quota when GEMINI_RPM isn't set in .env (free
+# tier for gemini-2.5-flash); paid keys should set their own quota
+DEFAULT_GEMINI_RPM = 10
+
+# Drafts the model rates at least this confident skip the critique-and-edit cycles
+SELF_CONFIDENCE_THRESHOLD = 0.8
+
+# Topics drafted per combined request; raise or lower it if answers come back truncated
+TOPIC_BATCH_SIZE = 8
+
+MODEL_NAME = "gemini-2.5-flash"
+# Greedy decoding: the analysis is factual, and identical prompts give identical answers for llm_cache
+TEMPERATURE = 0
+
+# Number of JSON retries across all threads, reported after each analysis
+numOfRetries = 0
+_retries_lock = threading.Lock()
+
+_RETRY_RE = re.compile(r"'retryDelay':\s*'(\d+)s'")
+_FENCE_HEAD_RE = re.compile(r"^```(?:json)?\s*", re.IGNORECASE)
+_FENCE_TAIL_RE = re.compile(r"\s*```$")
+_JSON_OBJECT_RE = re.compile(r"(\{.*\})", re.DOTALL)
+_TRAILING_COMMA_RE = re.compile(r",\s*(\]|\})")
+# Legal-form suffixes that don't change which company is meant
+_COMPANY_SUFFIX_RE = re.compile(r"[\s,]+(inc|incorporated|corp|corporation|ltd|limited|plc|llc)\.?$")
+_QUOTE_FIXES = str.maketrans({"“": "\"", "”": "\"", "'": "\""})
+# Either the takeaways heading or a **bold** span; `.` stops at newlines so spans never cross lines
+_FORMAT_RE = re.compile(r'(Summary of Key Takeaways:)|\*\*(.*?)\*\*')
+
+class JSONRetryExhausted(ValueError):
+    """Raised when a call never returned valid JSON. Carries the last raw response."""
+    def __init__(self, attempts: int, raw_response: str):
+        super().__init__(f"Failed to get valid JSON after {attempts} attempts. Last raw response: {raw_response}")
+        self.raw_response = raw_response
+
+def retry_on_json_error(max_retries=5, base_delay=1.0, max_delay=30.0):
     """
     A decorator that retries a function if it returns a dict with a 'raw_response' key,
-    which signals a JSON parsing failure.
+    which signals a JSON parsing failure. Waits grow exponentially (with jitter) up to
+    max_delay, and JSONRetryExhausted is raised once max_retries attempts have failed.
     """
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             global numOfRetries
             for attempt in range(max_retries):
-                numOfRetries += 1
+                if attempt:
+                    with _retries_lock:
+                        numOfRetries += 1
                 result = func(*args, **kwargs)
                 # Check for the specific failure signal from the decorated function
                 if isinstance(result, dict) and "raw_response" in result:
-                    print(f"⚠️ Invalid JSON format detected on attempt {attempt + 1}/{max_retries}. Retrying in {delay_seconds}s...")
                     # Don't wait on the last attempt before raising an error
                     if attempt < max_retries - 1:
-                        time.sleep(delay_seconds)
+                        delay = min(max_delay, base_delay * 2 ** attempt) + random.uniform(0, 0.25)
+                        print(f"⚠️ Invalid JSON format detected on attempt {attempt + 1}/{max_retries}. Retrying in {delay:.1f}s...")
+                        time.sleep(delay)
+                    else:
+                        print(f"⚠️ Invalid JSON format detected on attempt {attempt + 1}/{max_retries}.")
                 else:
                     # If the result is NOT the failure signal, it's a success.
                     print("✅ Successfully received valid JSON.")
                     return result
             # If the loop completes, all retries have failed.
-            # Raise an exception to stop the program gracefully.
-            raise ValueError(
-                f"Failed to get valid JSON after {max_retries} attempts. "
-                f"Last raw response: {result.get('raw_response', 'N/A')}"
-            )
+            raise JSONRetryExhausted(max_retries, result.get('raw_response', 'N/A'))
         return wrapper
     return decorator
 
@@ -82,473 +152,777 @@ def log_llm_call(func_name: str, prompt: str, response_text: str, model_name: st
         "tools_present": bool(getattr(generation_config, 'tools', False))
     }
 
-    log_entry = (
+    # The prompt and response are kept as separate pieces rather than
+    # concatenated into one multi-KB entry string first
+    log_header = (
         f"--- LLM Call Log Entry ---\n"
         f"Timestamp: {timestamp}\n"
         f"Function: {func_name}\n"
         f"Model: {model_name}\n"
         f"Generation Config: {gen_config_to_log}\n"
-        f"--- Prompt ---\n{prompt}\n"
-        f"--- Response ---\n{response_text}\n"
-        f"--------------------------\n\n"
+        f"--- Prompt ---\n"
     )
+    # Queued as one item so entries from different threads never interleave
+    _llm_log_queue.put_nowait((log_header, prompt, "\n--- Response ---\n", response_text, "\n--------------------------\n\n"))
+
+def _llm_log_writer():
+    """Drains the log queue into LLM_LOG_FILE from a single background thread."""
     try:
-        with open(LLM_LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(log_entry)
+        with open(LLM_LOG_FILE, "a", encoding="utf-8", buffering=1 << 16) as f:
+            while True:
+                log_pieces = _llm_log_queue.get()
+                if log_pieces is None:
+                    break
+                for piece in log_pieces:
+                    f.write(piece)
+                # Flush whenever the writer catches up so the log stays current
+                if _llm_log_queue.empty():
+                    f.flush()
     except IOError as e:
         print(f"Error writing to LLM log file {LLM_LOG_FILE}: {e}")
 
+def _stop_llm_log_writer():
+    """Writes out any queued entries before the interpreter exits."""
+    _llm_log_queue.put(None)
+    _llm_log_thread.join()
+
+_llm_log_thread = threading.Thread(target=_llm_log_writer, name="llm-log-writer", daemon=True)
+_llm_log_thread.start()
+atexit.register(_stop_llm_log_writer)
+
+class RateLimiter:
+    """
+    Token bucket shared by every worker thread. Callers block in acquire() until
+    a request fits under the per-minute quota, instead of hitting a 429 and
+    sleeping for the server's retry delay.
+    """
+    def __init__(self, rpm: int):
+        self.capacity = rpm
+        self.tokens = float(rpm)
+        self.refill_per_second = rpm / 60
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rpm(self, rpm: int):
+        """Changes the per-minute quota, starting from a full bucket."""
+        with self.lock:
+            self.capacity = rpm
+            self.tokens = float(rpm)
+            self.refill_per_second = rpm / 60
+            self.updated = time.monotonic()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.refill_per_second
+            time.sleep(wait_seconds)
+
+# Set to the configured quota by setup_api()
+rate_limiter = RateLimiter(DEFAULT_GEMINI_RPM)
+
+# Worker threads for topic chains, created once and reused by every analysis in the session
+llm_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="llm")
+
+# Company pipelines block on llm_executor futures, so they run in their own pool to
+# never starve it of workers
+company_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_COMPANIES, thread_name_prefix="company")
+
+# One client per API key, shared by every call so the HTTP connection pool inside it is reused
+_genai_clients = {}
+_genai_client_lock = threading.Lock()
+
+# Sized so every worker thread keeps a warm keep-alive connection to the Gemini endpoint;
+# with HTTP/2 concurrent calls are multiplexed over a few sockets instead of one each
+HTTP_LIMITS = httpx.Limits(
+    max_connections=2 * MAX_WORKERS,
+    max_keepalive_connections=MAX_WORKERS,
+    keepalive_expiry=60
+)
+
+# A stalled connection fails after this long (in milliseconds) and is retried by _call_with_retry,
+# instead of blocking its worker thread indefinitely
+HTTP_TIMEOUT_MS = 120_000
+
+def get_genai_client(api_key: str) -> genai.Client:
+    with _genai_client_lock:
+        client = _genai_clients.get(api_key)
+        if client is None:
+            client = _genai_clients[api_key] = genai.Client(
+                api_key=api_key,
+                http_options=types.HttpOptions(
+                    timeout=HTTP_TIMEOUT_MS,
+                    client_args={"limits": HTTP_LIMITS, "http2": True}
+                )
+            )
+        return client
+
+# Generation settings for every search-grounded call
+GROUNDED_CONFIG = types.GenerateContentConfig(
+    tools=[types.Tool(google_search=types.GoogleSearch())],
+    temperature=TEMPERATURE
+)
+
 class Topic(Enum):
-    HISTORY = ("History", 1)
-    PRODUCTS_INDUSTRY_MARKETSIZE = ("Products, Industry & Market Size", 2)
-    REVENUE_BREAKDOWN = ("Revenue Breakdown", 3)
-    CUSTOMERS = ("Customers", 4)
-    COMPETITIVE_LANDSCAPE = ("Competitive Landscape", 5)
-    FINANCIAL_PERFORMANCE = ("Financial Performance", 6)
-    STOCK_DRIVERS = ("Stock Drivers", 7)
-    INVESTMENT_RISKS = ("Investment Risks", 8)
-    def __init__ (self, label: str, code: int):
+    HISTORY = ("History", 1, """Business model evolution, Founding year, location, and founders,
+          Early products or services, Major funding rounds or IPO, Acquisitions,
+          partnerships, or divestitures, Strategic pivots or rebrandings,
+          Recent milestones (new CEO, geographic expansion)""")
+    PRODUCTS_INDUSTRY_MARKETSIZE = ("Products, Industry & Market Size", 2, '''Core offerings and adjacent R&D projects, Industry classification (e.g., "semiconductors"),
+          Total addressable market (TAM) with sources, Segment growth rates, Emerging trends shaping the market''')
+    REVENUE_BREAKDOWN = ("Revenue Breakdown", 3, '''Revenue per major product or service, Revenue by region (Americas, EMEA, APAC), YoY shifts in those percentages
+          Recurring vs. one-time revenue mix, Seasonality or quarter-to-quarter patterns, Effect of recent launches on mix''')
+    CUSTOMERS = ("Customers", 4, '''Customer segments and distribution channels, Key accounts and their impact, Recent wins or losses
+          Satisfaction, retention, and churn metrics, Acquisition cost and lifetime value. Please also identify top (10) customers
+          include them in your response''')
+    COMPETITIVE_LANDSCAPE = ("Competitive Landscape", 5, '''Direct and indirect competitors, Feature, price, and distribution comparisons, moats or differentiators,
+          Competitors' vulnerabilities, Recent competitor moves (M&A, new products), Disruption risks (startups, substitutes).''')
+    FINANCIAL_PERFORMANCE = ("Financial Performance", 6, '''Revenue growth trends, Gross and net margins, Cash flow dynamics, Debt ratios''')
+    STOCK_DRIVERS = ("Stock Drivers", 7, '''Upcoming product or roadmap milestones, Macro trends (interest rates, consumer spending), Analyst estimate revisions or consensus targets,
+          Catalysts (earnings beats, partnerships), Capital allocation (buybacks, dividends), Regulatory or geopolitical tailwinds''')
+    INVESTMENT_RISKS = ("Investment Risks", 8, '''Competitive pressure or price wars, Supply-chain or cost headwinds, Regulatory, legal, or antitrust scrutiny,
+          Currency or geopolitical exposure, Execution risks on new initiatives, Valuation or sentiment shifts''')
+    def __init__ (self, label: str, code: int, hints: str):
         self.label = label
         self.code = code
+        # Ideas the prompt suggests covering for this topic, collapsed onto one line so the
+        # source layout's indentation never ends up in a prompt
+        self.hints = " ".join(hints.split())
 
-def setup_api():
+class _Keys(NamedTuple):
+    gemini_api_key: str
+    open_router_api_key: Optional[str]
+
+@functools.lru_cache(maxsize=1)
+def setup_api() -> _Keys:
+    """
+    Loads the API keys and the GEMINI_RPM quota from .env once and sizes the rate limiter
+    to that quota; a missing Gemini key or invalid quota raises and is not cached.
+    """
     load_dotenv()
     open_router_api_key = os.getenv("OPENROUTER_API_KEY")
     gemini_api_key = os.getenv("GEMINI_API_KEY")
     if not gemini_api_key:
         raise ValueError("Please set API key in your .env file")
-    return gemini_api_key, open_router_api_key
-
-def generate_initial_prompt(company_name, topic: Topic):
-    topic_to_list = {
-        1: """Business model evolution, Founding year, location, and founders,
-              Early products or services, Major funding rounds or IPO, Acquisitions,
-              partnerships, or divestitures, Strategic pivots or rebrandings,
-              Recent milestones (new CEO, geographic expansion)""",
-        2: '''Core offerings and adjacent R&D projects, Industry classification (e.g., "semiconductors"),
-              Total addressable market (TAM) with sources, Segment growth rates, Emerging trends shaping the market''',
-        3: '''Revenue per major product or service, Revenue by region (Americas, EMEA, APAC), YoY shifts in those percentages
-              Recurring vs. one-time revenue mix, Seasonality or quarter-to-quarter patterns, Effect of recent launches on mix''',
-        4: '''Customer segments and distribution channels, Key accounts and their impact, Recent wins or losses
-              Satisfaction, retention, and churn metrics, Acquisition cost and lifetime value. Please also identify top (10) customers
-              include them in your response''',
-        5: '''Direct and indirect competitors, Feature, price, and distribution comparisons, moats or differentiators,
-              Competitors' vulnerabilities, Recent competitor moves (M&A, new products), Disruption risks (startups, substitutes).''',
-        6: '''Revenue growth trends, Gross and net margins, Cash flow dynamics, Debt ratios''',
-        7: '''Upcoming product or roadmap milestones, Macro trends (interest rates, consumer spending), Analyst estimate revisions or consensus targets,
-              Catalysts (earnings beats, partnerships), Capital allocation (buybacks, dividends), Regulatory or geopolitical tailwinds''',
-        8: '''Competitive pressure or price wars, Supply-chain or cost headwinds, Regulatory, legal, or antitrust scrutiny,
-              Currency or geopolitical exposure, Execution risks on new initiatives, Valuation or sentiment shifts'''
-    }
-
-    return _INITIAL_GEN_TEMPLATE.format(
-        today=today,
+    gemini_rpm = os.getenv("GEMINI_RPM", str(DEFAULT_GEMINI_RPM))
+    if not (gemini_rpm.strip().isdigit() and int(gemini_rpm) > 0):
+        raise ValueError(f"GEMINI_RPM must be a positive whole number, got {gemini_rpm!r}")
+    rate_limiter.set_rpm(int(gemini_rpm))
+    return _Keys(gemini_api_key, open_router_api_key)
+
+# Prompt builders with small, hashable inputs are memoized; retries and repeat
+# lookups for the same company rebuild the same string otherwise
+@functools.lru_cache(maxsize=256)
+def generate_initial_prompt(company_name, topic: Topic, today: date):
+    return _render(
+        _INITIAL_GEN_CHUNKS,
+        today=today.isoformat(),
         topic_label=topic.label,
         company_name=company_name,
-        topic_list=topic_to_list[topic.code]
+        topic_list=topic.hints
     )
 
-# Prompt to compare the company with its competitors
-def generate_comparison_prompt(company_name):
-    return _COMPARISON_TEMPLATE.format(
-        company_name=company_name,
+def generate_all_topics_prompt(company_name, topics, today: date):
+    """
+    Builds a single prompt that asks for every topic at once, returned as a JSON
+    object keyed by topic label.
+    """
+    topic_sections = "\n".join(
+        f"- **{topic.label}** (some ideas, not limited to: {topic.hints})"
+        for topic in topics
     )
-
-def generate_critique_prompt(company_name):
-    list_of_topics = ["History", "Products, Industry & Market Size", "Revenue Breakdown", 
-    "Customers", "Competitive Landscape", "Financial Performance", "Stock Drivers",
-    "Investment Risks"]
-    return _CRITIQUE_TEMPLATE.format(
-        today=today,
+    return _render(
+        _ALL_TOPICS_CHUNKS,
+        today=today.isoformat(),
         company_name=company_name,
-        list_of_topics=list_of_topics
+        topic_sections=topic_sections,
+        topic_labels=[topic.label for topic in topics]
     )
 
-def generate_edit_prompt(company_name, old_output, corrections_array):
-    """
-    corrections_array is expected to be a list of dicts:
-      [{"original": "...", "corrected": "...", "reasoning": "..."}, ...]
-    If a raw_response dict is passed (e.g. {"raw_response": "..."}) we embed that text instead.
-    """
-    if not corrections_array:
-        correction_output_string = "No corrections provided."
-        return _EDIT_TEMPLATE.format(today=today,  old_output=old_output, company_name=company_name, correction_output=correction_output_string)
-
-    # If we got the error wrapper
-    if isinstance(corrections_array, dict) and "raw_response" in corrections_array:
-        correction_output_string = corrections_array["raw_response"]
-        return _EDIT_TEMPLATE.format(today = today, old_output=old_output, company_name=company_name, correction_output=correction_output_string)
-
-    # If it's a dict keyed by topics -> lists, try to normalize it (handle both forms)
-    if isinstance(corrections_array, dict) and any(isinstance(v, list) for v in corrections_array.values()):
-        # flatten if {topic: [corrections]}
-        # get first list found
-        for v in corrections_array.values():
-            if isinstance(v, list):
-                corrections_list = v
-                break
-    else:
-        corrections_list = corrections_array
-
-    formatted_corrections = []
-    for i, correction in enumerate(corrections_list, 1):
-        original_sentence = correction.get('original', 'N/A')
-        corrected_sentence = correction.get('corrected', 'N/A')
-        reasoning = correction.get('reasoning', 'N/A')
-
-        correction_block = (
-            f"Correction #{i}:\n"
-            f'  - Original Snippet: "{original_sentence}"\n'
-            f'  - Corrected Snippet: "{corrected_sentence}"\n'
-            f"  - Reasoning for Change: {reasoning}"
-        )
-        formatted_corrections.append(correction_block)
-
-    correction_output_string = "\n\n".join(formatted_corrections)
-    return _EDIT_TEMPLATE.format(
-        today = today,
-        old_output=old_output,
+# Prompt to compare the company with its competitors
+@functools.lru_cache(maxsize=256)
+def generate_comparison_prompt(company_name):
+    return _render(
+        _COMPARISON_CHUNKS,
         company_name=company_name,
-        correction_output=correction_output_string
     )
 
-
-confNoJsonSearch = types.GenerationConfig(
-    temperature=0.2,
-)
-
-def generate_response(api_key: str, prompt: str) -> str:
-    model_name = "gemini-2.5-flash"
-    model = genai.Client()
-
-    # Define the grounding tool
-    grounding_tool = types.Tool(
-        google_search=types.GoogleSearch()
+def generate_critique_and_edit_prompt(company_name, topic_label, draft, today: date):
+    """
+    Builds a single prompt that fact-checks one topic's draft and returns the
+    rewritten analysis in the same response, as JSON:
+      {"all_good": bool, "revised": "..."}
+    """
+    return _render(
+        _CRITIQUE_AND_EDIT_CHUNKS,
+        today=today.isoformat(),
+        company_name=company_name,
+        topic_label=topic_label,
+        draft=draft
     )
 
-    # Configure generation settings
-    configX = types.GenerateContentConfig(
-        tools=[grounding_tool]
-    )
+def response_cache_key(prompt: str):
+    return llm_cache.cache_key(MODEL_NAME, prompt, TEMPERATURE)
 
-    attempt = 0
-    while True:
+def _call_with_retry(fn, *args, max_attempts=8, **kwargs):
+    """
+    Calls fn, retrying transient API failures:
+      - 429 RESOURCE_EXHAUSTED: waits for the server's suggested retry delay (60s if it gives none)
+      - 5xx responses and dropped or timed-out connections: exponential backoff capped at 30s
+    A little jitter is added so threads that failed together don't all retry at the same
+    instant. Any other error, or a failure on the last attempt, is re-raised.
+    """
+    for attempt in range(1, max_attempts + 1):
         try:
-            response = model.models.generate_content(
-                model=model_name,
-                contents=prompt,
-                config=configX,
-            )
-            response_text = response.text.strip()
-
-            match = re.search(r'\{.*\}', response_text, re.DOTALL)
-            
-            # if match:
-            #     json_string = match.group(0)
-            #     try:
-            #         # Attempt to parse the extracted, clean string
-            #         critique_json = json.loads(json_string)
-            #     except json.JSONDecodeError:
-            #         # The extracted string was still not valid JSON
-            #         print("⚠️ Could not parse the extracted JSON string.")
-            #         critique_json = {"raw_response": response_text}
-            # else:
-            #     # Could not find anything that looks like a JSON object
-            #     print("⚠️ No JSON object found in the response text.")
-            #     critique_json = {"raw_response": response_text}
-
-            # Log the LLM call with the config object directly
-            log_llm_call("generate_response", prompt, response_text, model_name, configX)
-            return response_text
+            return fn(*args, **kwargs)
         except Exception as e:
+            if attempt == max_attempts:
+                raise
             error_message = str(e)
+            status_code = getattr(e, "code", None)
             if "429" in error_message and "RESOURCE_EXHAUSTED" in error_message:
                 delay = 60
-                match = re.search(r"'retryDelay':\s*'(\d+)s'", error_message)
+                match = _RETRY_RE.search(error_message)
                 if match:
                     delay = int(match.group(1))
-                
-                attempt += 1
-                print(f"Quota exceeded (429) for {model_name}. API suggests retrying in {delay} seconds. Attempt {attempt}...")
-                time.sleep(delay)
+                reason = "Quota exceeded (429). API suggests retrying"
+            elif (isinstance(status_code, int) and status_code >= 500) or isinstance(e, httpx.TransportError):
+                delay = min(30, 2 ** (attempt - 1))
+                reason = f"Transient API error ({status_code or type(e).__name__}). Retrying"
             else:
-                print(f"An unexpected error occurred during LLM call: {error_message}")
                 raise
+            delay += random.uniform(0, 1)
+            print(f"{reason} in {delay:.0f} seconds. Attempt {attempt}/{max_attempts}...")
+            time.sleep(delay)
 
-@retry_on_json_error()
-def generate_critique_feedback(api_key, company_name, sorted_results_dict):
+class JSONMemberStream:
+    """
+    Scans a JSON object as it streams in and calls on_member(key, value) for each
+    top-level member as soon as its value is complete, so work on early members can
+    start before the rest of the answer arrives. Members that don't parse on their
+    own are skipped; the full answer is still parsed once the stream ends.
+    """
+    def __init__(self, on_member):
+        self.on_member = on_member
+        self.reset()
+
+    def reset(self):
+        """Forgets everything seen so far, e.g. when the request is retried."""
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.member_start = 0
+        self.done = False
+
+    def feed(self, chunk: str):
+        if self.done:
+            return
+        self.text += chunk
+        text = self.text
+        for i in range(self.pos, len(text)):
+            ch = text[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                # Quotes before the opening brace (e.g. a stray preamble) don't start a string
+                self.in_string = self.depth > 0
+            elif ch in "{[":
+                self.depth += 1
+                if self.depth == 1:
+                    self.member_start = i + 1
+            elif ch in "}]" and self.depth:
+                if self.depth == 1:
+                    self._emit(text[self.member_start:i])
+                    self.done = True
+                    break
+                self.depth -= 1
+            elif ch == "," and self.depth == 1:
+                self._emit(text[self.member_start:i])
+                self.member_start = i + 1
+        self.pos = len(text)
+
+    def _emit(self, member: str):
+        if not member.strip():
+            return
+        try:
+            parsed = orjson.loads("{" + member + "}")
+        except orjson.JSONDecodeError:
+            return
+        for key, value in parsed.items():
+            self.on_member(key, value)
+
+def generate_response(api_key: str, prompt: str, stream: JSONMemberStream = None) -> str:
     """
-    Sends the critique prompt and robustly extracts JSON from the model response.
-    `sorted_results_dict` should be a mapping: { "Topic Name": "draft text", ... }
+    Returns the model's answer to prompt. If stream is given, every chunk of text is
+    also fed to it as it arrives (a cached answer is fed in one piece).
     """
-    client = genai.Client(api_key=api_key)           # <-- ensure API key is used
-    model_name = "gemini-2.5-flash"
+    model_name = MODEL_NAME
+
+    cache_key = response_cache_key(prompt)
+    if cache_key:
+        cached_text = llm_cache.get(cache_key)
+        if cached_text is not None:
+            if stream:
+                stream.feed(cached_text)
+            return cached_text
+
+    model = get_genai_client(api_key)
+    configX = GROUNDED_CONFIG
+
+    def stream_answer():
+        rate_limiter.acquire()
+        if stream:
+            stream.reset()
+        # Stream the answer and join the chunks once at the end
+        response_chunks = []
+        for chunk in model.models.generate_content_stream(
+            model=model_name,
+            contents=prompt,
+            config=configX,
+        ):
+            # Chunks that only carry grounding metadata have no text
+            if chunk.text:
+                response_chunks.append(chunk.text)
+                if stream:
+                    stream.feed(chunk.text)
+        return "".join(response_chunks).strip()
 
-    # Define search grounding tool
-    grounding_tool = types.Tool(google_search=types.GoogleSearch())
+    try:
+        response_text = _call_with_retry(stream_answer)
+    except Exception as e:
+        print(f"LLM call failed: {e}")
+        raise
 
-    configX = types.GenerateContentConfig(
-        tools=[grounding_tool],
-    )
+    # Log the LLM call with the config object directly
+    log_llm_call("generate_response", prompt, response_text, model_name, configX)
+    if cache_key:
+        llm_cache.set(cache_key, response_text)
+    return response_text
 
-    critique_instructions = generate_critique_prompt(company_name)
+def extract_json(response_text: str) -> dict:
+    """
+    Robustly extracts the first JSON object from a model response.
+    Returns {"raw_response": response_text} if nothing parseable is found.
+    """
+    response_text = response_text.strip()
 
-    # Build prompt
-    full_prompt_for_critique = critique_instructions + "\n\n"
-    for topic_name, response_content in sorted_results_dict.items():
-        full_prompt_for_critique += (
-            f"--- TOPIC: {topic_name} ---\n"
-            f"{response_content.strip()}\n\n"
-        )
+    # Remove markdown code fences if present (```json ... ```)
+    # Also remove a single leading "```json" or "```" and trailing "```"
+    response_text = _FENCE_HEAD_RE.sub("", response_text)
+    response_text = _FENCE_TAIL_RE.sub("", response_text)
 
-    full_prompt_for_critique += (
-        "Return your response strictly as valid JSON following the output format described above. "
-        "Do not add any commentary, markdown, or notes."
-    )
+    # Extract the first JSON object/braced block if there is extra text
+    match = _JSON_OBJECT_RE.search(response_text)
+    if not match:
+        # No braced JSON found — return raw_response for debugging
+        print("⚠️ No JSON object found in the response text.")
+        return {"raw_response": response_text}
 
-    attempt = 0
-    while True:
+    json_string = match.group(1)
+    try:
+        return orjson.loads(json_string)
+    except orjson.JSONDecodeError:
+        # Last-ditch attempts to "fix" common issues:
+        # - replace smart-quotes / single quotes -> double quotes
+        safe = json_string.translate(_QUOTE_FIXES)
+        # remove trailing commas like `,]` or `,}`
+        safe = _TRAILING_COMMA_RE.sub(r"\1", safe)
         try:
-            response = client.models.generate_content(
-                model=model_name,
-                contents=full_prompt_for_critique,
-                config=configX
-            )
+            return orjson.loads(safe)
+        except Exception:
+            print("⚠️ Could not parse the extracted JSON string after cleanup.")
+            return {"raw_response": response_text}
 
-            # Try safe extraction of text (SDKs return different shapes)
-            response_text = None
-            if hasattr(response, "text") and response.text:
-                response_text = response.text
-            else:
-                # fallback: try to find nested structure (adjust if your SDK shape differs)
-                try:
-                    # many SDKs put model output in response.output[0].content[0].text
-                    response_text = response.output[0].content[0].text
-                except Exception:
-                    response_text = repr(response)
-
-            response_text = response_text.strip()
-
-            # Remove markdown code fences if present (```json ... ```)
-            # Also remove a single leading "```json" or "```" and trailing "```"
-            response_text = re.sub(r"^```(?:json)?\s*", "", response_text, flags=re.IGNORECASE)
-            response_text = re.sub(r"\s*```$", "", response_text)
-
-            # Extract the first JSON object/braced block if there is extra text
-            match = re.search(r"(\{.*\})", response_text, re.DOTALL)
-            if match:
-                json_string = match.group(1)
-                try:
-                    critique_json = json.loads(json_string)
-                except json.JSONDecodeError:
-                    # Last-ditch attempts to "fix" common issues:
-                    # - replace smart-quotes / single quotes -> double quotes
-                    safe = json_string.replace("“", "\"").replace("”", "\"").replace("'", "\"")
-                    # remove trailing commas like `,]` or `,}`
-                    safe = re.sub(r",\s*(\]|\})", r"\1", safe)
-                    try:
-                        critique_json = json.loads(safe)
-                    except Exception:
-                        print("⚠️ Could not parse the extracted JSON string after cleanup.")
-                        critique_json = {"raw_response": response_text}
-            else:
-                # No braced JSON found — return raw_response for debugging
-                print("⚠️ No JSON object found in the response text.")
-                critique_json = {"raw_response": response_text}
-
-            log_llm_call(
-                "generate_critique_feedback",
-                full_prompt_for_critique,
-                response_text,
-                model_name,
-                configX
-            )
-            return critique_json
+def generate_json_response(api_key: str, prompt: str, stream: JSONMemberStream = None) -> dict:
+    """
+    Calls the LLM and extracts a JSON object from its answer. Unparseable answers
+    are evicted from the response cache so a retry asks the model again.
+    """
+    result = extract_json(generate_response(api_key, prompt, stream))
+    if "raw_response" in result:
+        cache_key = response_cache_key(prompt)
+        if cache_key:
+            llm_cache.delete(cache_key)
+    return result
+
+@retry_on_json_error(max_retries=2)
+def generate_all_topics(api_key, company_name, topics, today: date, on_topic=None):
+    """
+    Drafts every topic in a single LLM round-trip.
+    Returns a dict mapping topic label -> {"analysis": "...", "self_confidence": float}.
+    If on_topic is given, it is called with (topic label, draft JSON) as each topic
+    finishes streaming.
+    """
+    prompt = generate_all_topics_prompt(company_name, topics, today)
+    return generate_json_response(api_key, prompt, JSONMemberStream(on_topic) if on_topic else None)
+
+@retry_on_json_error()
+def generate_critique_and_edit(api_key, company_name, topic_label, draft, today: date):
+    """
+    Fact-checks and rewrites a single topic's draft in one LLM round-trip.
+    Returns {"all_good": bool, "revised": "..."}.
+    """
+    prompt = generate_critique_and_edit_prompt(company_name, topic_label, draft, today)
+    return generate_json_response(api_key, prompt)
 
+def refine_topic(api_key, company_name, topic_label, draft, amount_of_cycles, today: date):
+    """
+    Runs critique-and-edit cycles on a single topic until the model reports it
+    is all good or amount_of_cycles is reached. Returns the final draft.
+    """
+    for _ in range(amount_of_cycles):
+        try:
+            critique = generate_critique_and_edit(api_key, company_name, topic_label, draft, today)
+        except JSONRetryExhausted:
+            print(f"⚠️ [{company_name}] Critique for '{topic_label}' never returned valid JSON. Keeping the current draft.")
+            break
         except Exception as e:
-            error_message = str(e)
-            if "429" in error_message and "RESOURCE_EXHAUSTED" in error_message:
-                delay = 60
-                match = re.search(r"'retryDelay':\s*'(\d+)s'", error_message)
-                if match:
-                    delay = int(match.group(1))
-                attempt += 1
-                print(f"Quota exceeded (429). Retrying in {delay} seconds. Attempt {attempt}...")
-                time.sleep(delay)
-            else:
-                print(f"❌ Unexpected error in critique call: {error_message}")
-                raise
+            # An API error that outlasted _call_with_retry costs this topic's polish, not the report
+            print(f"⚠️ [{company_name}] Critique for '{topic_label}' failed: {e}. Keeping the current draft.")
+            break
+        if critique.get("all_good"):
+            # Nothing left to fix, so stop critiquing this topic
+            break
 
+        revised = critique.get("revised")
+        if not (isinstance(revised, str) and revised.strip()):
+            # The same prompt would come back from llm_cache with the same answer, so stop here
+            print(f"[{company_name}] Skipping edit for '{topic_label}' due to invalid data.")
+            break
+        if " ".join(revised.split()) == " ".join(draft.split()):
+            # A rewrite that changes nothing is an implicit all good; another cycle would see the same draft
+            break
+        draft = revised
+    return draft
 
 def apply_ansi_formatting(text: str) -> str:
     """
-    Splits text by newline characters and applies ANSI escape codes for bold to text
-    enclosed in double asterisks (**) and changes "Summary of Key Takeaways:" to bold.
+    Applies ANSI escape codes for bold to text enclosed in double asterisks (**)
+    and changes "Summary of Key Takeaways:" to bold, in a single pass over the text.
     """
     BOLD = "\033[1m"
     RESET = "\033[0m"
-    
-    lines = text.splitlines()
-    formatted_lines = []
-    for line in lines:
-        if "Summary of Key Takeaways:" in line:
-            line = line.replace("Summary of Key Takeaways:", f"{BOLD}Summary of Key Takeaways:{RESET}")
-        
-        def replace_bold_markers(match):
-            return f"{BOLD}{match.group(1)}{RESET}"
-        
-        line = re.sub(r'\*\*(.*?)\*\*', replace_bold_markers, line)
-        formatted_lines.append(line)
-        
-    return "\n".join(formatted_lines)
-
-# def analyze_single_topic(company_name: str, topic: Topic, gemini_api_key: str) -> tuple[str, str]:
-#     """
-#     Generates, critiques, and refines the analysis for a single topic.
-#     Returns a tuple containing the topic label and the final refined analysis string.
-#     """
-#     # 1. Generate rough draft
-#     prompt = generate_topic_prompt(company_name, topic)
-#     current_analysis = generate_response(gemini_api_key, prompt)
-
-#     # It's also good practice to check if the initial analysis is valid
-#     if not current_analysis:
-#         print(f"Warning: Initial analysis generation for '{topic.label}' failed. Skipping topic.")
-#         return (topic.label, "Analysis could not be generated for this topic.")
-    
-#     # 2. Critique and Redraft loop
-#     amount_of_cycles = 3
-#     count = 0
-#     while count < amount_of_cycles:
-#         correction_output = generate_critique_feedback(gemini_api_key, company_name, current_analysis, prompt)
-        
-#         # <<< CHANGE: Implement the "retry once" logic >>>
-#         # If the first attempt fails, try one more time.
-#         if correction_output is None:
-#             print(f"Warning: Critique generation for '{topic.label}' returned no output. Retrying once...")
-#             correction_output = generate_critique_feedback(gemini_api_key, company_name, current_analysis, prompt)
-
-#         # Now, check again. If it's still None after the retry, then break.
-#         if correction_output is None:
-#             print(f"Warning: Critique generation for '{topic.label}' failed after a retry. Using the last available analysis.")
-#             break # Exit the critique loop and proceed with the current analysis
-#         # <<< END OF CHANGE >>>
-
-#         if correction_output.strip().upper() == "ALL GOOD":
-#             break
-#         else:
-#             edit_prompt = generate_edit_prompt(company_name, current_analysis, correction_output)
-#             current_analysis = generate_response(gemini_api_key, edit_prompt)
-#             # Add a check here as well in case the edit response fails
-#             if not current_analysis:
-#                  print(f"Warning: Edit generation for '{topic.label}' failed. Using the previous version.")
-#                  break
-#             count += 1
-            
-#     return (topic.label, current_analysis)
-
-def initial_gen (company_name: str, topic: Topic, gemini_api_key: str):
-    prompt = generate_initial_prompt(company_name, topic)
-    return generate_response(gemini_api_key, prompt)
+
+    def replace_bold_markers(match):
+        return f"{BOLD}{match.group(1) or match.group(2)}{RESET}"
+
+    return _FORMAT_RE.sub(replace_bold_markers, text)
+
+def normalize_company_name(company_name: str) -> str:
+    """
+    Canonical form of a company name for cache keys: lower case, single spaces and no
+    legal-form suffix, so "Apple Inc." and "apple" map to the same entry.
+    """
+    name = " ".join(company_name.lower().split())
+    return _COMPANY_SUFFIX_RE.sub("", name) or name
+
+# Parsed drafts for this session as (analysis, self_confidence), keyed by (normalized company
+# name, topic code, date), so re-entering a company with different casing, spacing or legal
+# suffix skips drafting. Least recently used entries are evicted past DRAFT_CACHE_SIZE
+DRAFT_CACHE_SIZE = 256
+_draft_cache = OrderedDict()
+_draft_cache_lock = threading.Lock()
+
+def get_cached_draft(company_name: str, topic: Topic, today: date):
+    """Returns the cached (analysis, self_confidence) for a topic, or None."""
+    draft_key = (normalize_company_name(company_name), topic.code, today)
+    with _draft_cache_lock:
+        draft = _draft_cache.get(draft_key)
+        if draft is not None:
+            _draft_cache.move_to_end(draft_key)
+        return draft
+
+def cache_draft(company_name: str, topic: Topic, today: date, analysis: str, self_confidence: float):
+    draft_key = (normalize_company_name(company_name), topic.code, today)
+    with _draft_cache_lock:
+        _draft_cache[draft_key] = (analysis, self_confidence)
+        _draft_cache.move_to_end(draft_key)
+        if len(_draft_cache) > DRAFT_CACHE_SIZE:
+            _draft_cache.popitem(last=False)
+
+@retry_on_json_error()
+def initial_gen (company_name: str, topic: Topic, gemini_api_key: str, today: date):
+    """Returns {"analysis": "...", "self_confidence": float} for a single topic."""
+    cached_draft = get_cached_draft(company_name, topic, today)
+    if cached_draft is not None:
+        return {"analysis": cached_draft[0], "self_confidence": cached_draft[1]}
+
+    prompt = generate_initial_prompt(company_name, topic, today)
+    draft = generate_json_response(gemini_api_key, prompt)
+    analysis, self_confidence = parse_draft(draft)
+    if analysis:
+        cache_draft(company_name, topic, today, analysis, self_confidence)
+    return draft
+
+def parse_draft(draft_json):
+    """
+    Returns (analysis, self_confidence) from a draft JSON object, or (None, 0.0)
+    if the draft is malformed. A missing or invalid confidence counts as 0.0.
+    """
+    if not isinstance(draft_json, dict):
+        return None, 0.0
+    analysis = draft_json.get("analysis")
+    if not (isinstance(analysis, str) and analysis.strip()):
+        return None, 0.0
+    try:
+        self_confidence = float(draft_json.get("self_confidence", 0.0))
+    except (TypeError, ValueError):
+        self_confidence = 0.0
+    return analysis, self_confidence
+
+def draft_topic_batch(api_key: str, company_name: str, topics: list, today: date, on_draft=None) -> dict:
+    """
+    Drafts a batch of topics with one combined call.
+    Returns topic label -> (analysis, self_confidence) for every topic the answer covered.
+    Topics already in the draft cache are served from it and left out of the request.
+    If on_draft is given, it is called with (topic label, analysis, self_confidence) once
+    per topic, as soon as that topic's draft has streamed in.
+    """
+    drafts = {}
+    topics_to_draft = []
+    for topic in topics:
+        cached_draft = get_cached_draft(company_name, topic, today)
+        if cached_draft is None:
+            topics_to_draft.append(topic)
+            continue
+        drafts[topic.label] = cached_draft
+        if on_draft:
+            on_draft(topic.label, *cached_draft)
+    if not topics_to_draft:
+        return drafts
+
+    topics_by_label = {topic.label: topic for topic in topics_to_draft}
+
+    def add_draft(topic_label, draft_json):
+        if topic_label not in topics_by_label or topic_label in drafts:
+            return
+        analysis, self_confidence = parse_draft(draft_json)
+        if analysis:
+            drafts[topic_label] = (analysis, self_confidence)
+            cache_draft(company_name, topics_by_label[topic_label], today, analysis, self_confidence)
+            if on_draft:
+                on_draft(topic_label, analysis, self_confidence)
+
+    try:
+        all_topics = generate_all_topics(api_key, company_name, topics_to_draft, today, on_topic=add_draft)
+    except JSONRetryExhausted:
+        print(f"⚠️ [{company_name}] Combined generation failed for {len(topics_to_draft)} topics.")
+        all_topics = {}
+    except Exception as e:
+        # Drafts streamed before the error are kept; the rest fall back to the per-topic path
+        print(f"⚠️ [{company_name}] Combined generation failed for {len(topics_to_draft)} topics: {e}")
+        all_topics = {}
+
+    # Picks up anything the stream scan couldn't parse on its own (e.g. quotes fixed by extract_json)
+    for topic in topics_to_draft:
+        add_draft(topic.label, all_topics.get(topic.label))
+    return drafts
+
+def draft_topic_batches(api_key: str, company_name: str, batches: list, today: date, on_draft=None) -> dict:
+    """Drafts several batches concurrently and merges their drafts."""
+    futures = [llm_executor.submit(draft_topic_batch, api_key, company_name, batch, today, on_draft) for batch in batches]
+    drafts = {}
+    for future in futures:
+        drafts.update(future.result())
+    return drafts
+
+def draft_topics(api_key: str, company_name: str, topics: list, today: date, on_draft=None) -> dict:
+    """
+    Drafts topics with combined calls of up to TOPIC_BATCH_SIZE topics each.
+    Topics a batch leaves out (e.g. a long answer hit the output token limit) are
+    retried once as two smaller batches; whatever is still missing is left to the
+    per-topic path. Returns topic label -> (analysis, self_confidence).
+    """
+    batches = [topics[i:i + TOPIC_BATCH_SIZE] for i in range(0, len(topics), TOPIC_BATCH_SIZE)]
+    drafts = draft_topic_batches(api_key, company_name, batches, today, on_draft)
+
+    missing_topics = [topic for topic in topics if topic.label not in drafts]
+    if len(missing_topics) > 1:
+        half = (len(missing_topics) + 1) // 2
+        print(f"⚠️ [{company_name}] {len(missing_topics)} topics missing from the combined answer. Retrying them in two smaller batches.")
+        drafts.update(draft_topic_batches(api_key, company_name, [missing_topics[:half], missing_topics[half:]], today, on_draft))
+    return drafts
+
+def draft_and_refine_topic(company_name: str, topic: Topic, gemini_api_key: str, amount_of_cycles: int, today: date):
+    """
+    Drafts a single topic and, unless the model is confident in the draft, refines it
+    straight away instead of waiting for the other topics' drafts.
+    """
+    try:
+        analysis, self_confidence = parse_draft(initial_gen(company_name, topic, gemini_api_key, today))
+    except JSONRetryExhausted:
+        print(f"⚠️ [{company_name}] Draft for '{topic.label}' never returned valid JSON.")
+        return None
+    except Exception as e:
+        print(f"⚠️ [{company_name}] Draft for '{topic.label}' failed: {e}")
+        return None
+    print(f"-> [{company_name}] Draft for '{topic.label}' completed.")
+    if analysis and self_confidence < SELF_CONFIDENCE_THRESHOLD:
+        analysis = refine_topic(gemini_api_key, company_name, topic.label, analysis, amount_of_cycles, today)
+    return analysis
+
+def analyze_single_company(gemini_api_key: str, company_name: str) -> str:
+    """
+    Runs the full pipeline (semantic cache, drafting, critique-and-edit) for one company
+    and returns its formatted report.
+    """
+    topics = list(Topic)
+    start_time = time.perf_counter()
+
+    amount_of_cycles = 3
+    # Computed per analysis so a long-running session never uses a stale date
+    today = date.today()
+
+    # One slot per topic, in report order; None until the topic has an analysis
+    sorted_results = dict.fromkeys(topic.label for topic in topics)
+    # Labels whose timing line has been printed, so each topic is reported exactly once
+    timed_topics = set()
+    timed_topics_lock = threading.Lock()
+
+    def report_topic_time(topic_label):
+        # Time since this company's analysis started, to see which topics bound the total
+        with timed_topics_lock:
+            if topic_label in timed_topics:
+                return
+            timed_topics.add(topic_label)
+        print(f"-> [{company_name}] Analysis for '{topic_label}' completed in {time.perf_counter() - start_time:.1f}s.")
+
+    company_key = normalize_company_name(company_name)
+    # Reuse final analyses of the same company, entered with any casing, spacing or legal suffix
+    for topic in topics:
+        cached_analysis = semantic_cache.lookup(company_key, topic.label)
+        if cached_analysis is not None:
+            sorted_results[topic.label] = cached_analysis
+            report_topic_time(topic.label)
+
+    topics_to_generate = [topic for topic in topics if sorted_results[topic.label] is None]
+
+    # Each topic runs as an independent chain, so a topic that is all good (or fast) never
+    # waits on the slowest topic, and a topic drafted on its own is refined as soon as
+    # its own draft is ready
+    topic_futures = {}
+    topic_futures_lock = threading.Lock()
+
+    def refine_draft(topic_label, analysis, self_confidence):
+        # Only drafts the model isn't confident about go through critique-and-edit. Called
+        # from the drafting threads as each topic streams in, so refinement of early topics
+        # overlaps with the rest of the combined answer
+        if self_confidence >= SELF_CONFIDENCE_THRESHOLD:
+            # Confident drafts are final as soon as they arrive
+            report_topic_time(topic_label)
+            return
+        with topic_futures_lock:
+            if topic_label in topic_futures.values():
+                return
+            future = llm_executor.submit(refine_topic, gemini_api_key, company_name, topic_label, analysis, amount_of_cycles, today)
+            topic_futures[future] = topic_label
+
+    # Draft topics with combined requests; anything still missing falls back to one call per topic
+    drafts = draft_topics(gemini_api_key, company_name, topics_to_generate, today, on_draft=refine_draft) if topics_to_generate else {}
+    for topic_label, (analysis, self_confidence) in drafts.items():
+        sorted_results[topic_label] = analysis
+        refine_draft(topic_label, analysis, self_confidence)
+
+    for topic in topics_to_generate:
+        if sorted_results[topic.label] is None:
+            # Missing from the combined call, so draft it on its own first
+            future = llm_executor.submit(draft_and_refine_topic, company_name, topic, gemini_api_key, amount_of_cycles, today)
+            topic_futures[future] = topic.label
+
+    for future in as_completed(topic_futures):
+        topic_label = topic_futures[future]
+        sorted_results[topic_label] = future.result()
+        report_topic_time(topic_label)
+
+    semantic_cache.add_all(company_name, company_key, {
+        topic.label: sorted_results[topic.label]
+        for topic in topics_to_generate
+        if sorted_results[topic.label]
+    })
+
+    # Build the whole report first and write it once, so it isn't interleaved with worker output
+    report = io.StringIO()
+    # sorted_results is already in report order, so no sorting is needed
+    for topic_label, analysis_text in sorted_results.items():
+
+        # Write a clear, differentiating header for each topic
+        report.write(f"\n\n{'='*70}\n")
+        report.write(f"TOPIC: {topic_label.upper()}\n")
+        report.write(f"{'='*70}\n\n")
+
+        if analysis_text:
+            # Apply formatting and write the analysis for the topic
+            report.write(apply_ansi_formatting(analysis_text))
+            report.write("\n")
+        else:
+            # This is a fallback in case a result for a topic was never generated.
+            report.write("Analysis for this topic could not be found.\n")
+    return report.getvalue()
+
+def split_company_names(user_input: str) -> list:
+    """
+    Splits comma-separated input into company names. A fragment that is only a legal-form
+    suffix stays with the name before it, so "Apple, Inc., Microsoft" is two companies.
+    """
+    company_names = []
+    for fragment in user_input.split(","):
+        name = fragment.strip()
+        if not name:
+            continue
+        if company_names and _COMPANY_SUFFIX_RE.match(", " + name.lower()):
+            company_names[-1] = f"{company_names[-1]}, {name}"
+        else:
+            company_names.append(name)
+    return company_names
 
 def analyze_company(gemini_api_key: str, open_router_api_key: str):
     print("Welcome to Company Analysis Bot!")
     print("This bot will provide a comprehensive analysis of any company.\n")
     while True:
-        company_name = input("Enter company name (or 'exit' to quit): ")
-        if company_name.lower() in ['exit', 'quit']:
+        user_input = input("Enter company name, or several separated by commas (or 'exit' to quit): ")
+        if user_input.strip().lower() in ['exit', 'quit']:
             print("\nGoodbye!")
             break
-        
+        company_names = split_company_names(user_input)
+        if not company_names:
+            continue
+
         start_time = time.perf_counter()
-        
-        print(f"\nGenerating a comprehensive analysis for {company_name}. This may take a few minutes...")
-        try:
-            topics = list(Topic)
-
-            amount_of_cycles = 3
-
-            count = 0
-            sorted_results = {}
-            ordered_futures = []
-            with ThreadPoolExecutor(max_workers=8) as exe:
-                for topic in topics:
-                    # print(topic);
-                    # print("____")
-                    future = exe.submit(initial_gen, company_name, topic, gemini_api_key)
-                    ordered_futures.append((topic.label, future))
-                for code, future in sorted(ordered_futures):
-                    sorted_results[code] = future.result()
-
-            while (count < amount_of_cycles):
-#                 sorted_results ={"Investment Risks": '''NVIDIA faces several investment risks despite its dominant position in the AI chip market. Geopolitical tensions, particularly between the U.S. and China, pose a significant headwind, evidenced by the $4.5 billion charge incurred in Q1 FY2026 due to excess H20 inventory following new U.S. export licensing requirements for China, which also impacted the GAAP gross margin to 60.5% (non-GAAP 61.0%). NVIDIA estimates a further $8.0 billion loss in H20 revenue for Q2 FY2026, for which it has guided revenue of $45.0 billion, plus or minus 2%. Regulatory scrutiny is intensifying, with antitrust investigations by the French Competition Authority and the U.S. Department of Justice examining NVIDIA's market dominance and proprietary CUDA software, alongside China's recent inquiries into potential "backdoors" in H20 chips. Competitive pressures are rising as rivals like Amazon offer aggressively priced AI chips, and major cloud providers develop in-house alternatives, potentially eroding NVIDIA's market share and affecting its high gross margins, which were 71.3% non-GAAP excluding the H20 charge in Q1 FY2026. Furthermore, NVIDIA's premium valuation, with a P/E ratio of 60.1, reflects high growth expectations, making it susceptible to significant corrections if growth decelerates or market sentiment shifts.
-
-# Summary of Key Takeaways:
-# *   Geopolitical tensions, particularly U.S.-China export restrictions, directly impact NVIDIA's revenue and gross margins, as seen with the $4.5 billion Q1 FY2026 charge related to H20 chips and the projected $8.0 billion revenue loss in Q2 FY2026 from China.
-# *   Increased regulatory and antitrust scrutiny from multiple jurisdictions (U.S., France, China) presents legal and operational risks due to NVIDIA's market dominance and proprietary technology.
-# *   Competitive pressures from existing rivals and large tech companies developing in-house AI chips could lead to price wars and market share erosion, potentially impacting profitability.
-# *   NVIDIA's high valuation multiples indicate that its stock is priced for continued robust growth, making it vulnerable to market corrections if growth expectations are not met.'''}
-
-                critique_feedback = generate_critique_feedback(gemini_api_key, company_name, sorted_results)
-
-                # critique_feedback = {'Investment Risks': [{'original': 'NVIDIA faces several investment risks despite its dominant position in the AI chip market. Geopolitical tensions, particularly between the U.S. and China, pose a significant headwind, evidenced by the $4.5 billion charge incurred in Q1 FY2026 due to excess H20 inventory following new U.S. export licensing requirements for China, which also impacted the GAAP gross margin to 60.5% (non-GAAP 61.0%).', 'corrected': 'NVIDIA faces several investment risks despite its dominant position in the AI chip market. Geopolitical tensions, particularly between the U.S. and China, pose a significant headwind, evidenced by the $4.5 billion charge incurred in Q1 FY2026 (ended April 27, 2025) due to excess H20 inventory and purchase obligations following new U.S. export licensing requirements for China, which also impacted the GAAP gross margin to 60.5% (non-GAAP 61.0%). [11, 21, 26, 28]', 'reasoning': "Added the end date for Q1 FY2026 for more precise context and added 'purchase obligations' to accurately reflect the nature of the charge as reported by NVIDIA. Added citations."}, {'original': 'NVIDIA estimates a further $8.0 billion loss in H20 revenue for Q2 FY2026, for which it has guided revenue of $45.0 billion, plus or minus 2%.', 'corrected': 'NVIDIA estimates a further $8.0 billion loss in H20 revenue for Q2 FY2026, for which it has guided revenue of $45.0 billion, plus or minus 2%. [11, 17, 22, 26, 28]', 'reasoning': 'Added citations to verify the revenue loss estimate and guidance.'}, {'original': 'Regulatory scrutiny is intensifying, with antitrust investigations by the French Competition Authority and the U.S. Department of Justice examining NVIDIA\'s market dominance and proprietary CUDA software, alongside China\'s recent inquiries into potential "backdoors" in H20 chips.', 'corrected': 'Regulatory scrutiny is intensifying, with active antitrust investigations by the French Competition Authority and the U.S. Department of Justice examining NVIDIA\'s market dominance and proprietary CUDA software, alongside China\'s recent inquiries (as of late July/early August 2025) into potential "backdoors" in H20 chips. [3, 5, 7, 8, 10, 12, 13, 16, 20, 24]', 'reasoning': "Added 'active' for clarity on the ongoing nature of investigations and specified the timeframe for China's inquiries for more precision. Added citations."}, {'original': "Competitive pressures are rising as rivals like Amazon offer aggressively priced AI chips, and major cloud providers develop in-house alternatives, potentially eroding NVIDIA's market share and affecting its high gross margins, which were 71.3% non-GAAP excluding the H20 charge in Q1 FY2026.", 'corrected': "Competitive pressures are rising as rivals like Amazon offer aggressively priced AI chips (e.g., Inferentia and Trainium), and major cloud providers (e.g., Google, Microsoft, Amazon) develop in-house alternatives (e.g., Google TPUs, Microsoft Azure Maia, Amazon Trainium), potentially eroding NVIDIA's market share and affecting its high gross margins, which were 71.3% non-GAAP excluding the H20 charge in Q1 FY2026. [11, 18, 19, 21, 25, 27, 28, 29, 30, 31, 33, 34]", 'reasoning': 'Provided specific examples of aggressively priced chips (Inferentia, Trainium) and in-house alternatives (Google TPUs, Microsoft Azure Maia, Amazon Trainium) for better clarity and context. Added citations.'}, {'original': "Furthermore, NVIDIA's premium valuation, with a P/E ratio of 60.1, reflects high growth expectations, making it susceptible to significant corrections if growth decelerates or market sentiment shifts.", 'corrected': "Furthermore, NVIDIA's premium valuation, with a trailing twelve-month (TTM) P/E ratio of approximately 57.6 as of August 8, 2025, reflects high growth expectations, making it susceptible to significant corrections if growth decelerates or market sentiment shifts. [2, 4, 6, 9]", 'reasoning': 'Corrected the P/E ratio to reflect the most current and accurate TTM P/E (approx. 57.6) as of the specified date (August 8, 2025) and clarified it as TTM, enhancing precision. Added citations.'}]}
-
-                # print(critique_feedback);
-
-                edit_futures = {}
-
-                with ThreadPoolExecutor(max_workers=8) as exe:
-                    for topic_name, corrections_array in critique_feedback.items():
-                        original_draft = sorted_results.get(topic_name)
-
-                        if original_draft and isinstance(corrections_array, list):
-                            edit_prompt = generate_edit_prompt(company_name, original_draft, corrections_array)
-                            # Submit the job and store the future object
-                            future = exe.submit(generate_response, gemini_api_key, edit_prompt)
-                            edit_futures[topic_name] = future
-                        else:
-                             print(f"Skipping edit for '{topic_name}' due to invalid data.")
-#                         new_draft = """NVIDIA faces several investment risks despite its dominant position in the AI chip market. Geopolitical tensions, particularly between the U.S. and China, pose a significant headwind, evidenced by the $4.5 billion charge incurred in Q1 FY2026 (ended April 27, 2025) due to excess H20 inventory and purchase obligations following new U.S. export licensing requirements for China, which also impacted the GAAP gross margin to 60.5% (non-GAAP 61.0%). NVIDIA estimates a further $8.0 billion loss in H20 revenue for Q2 FY2026, for which it has guided revenue of $45.0 billion, plus or minus 2%. Regulatory scrutiny is intensifying, with active antitrust investigations by the French Competition Authority and the U.S. Department of Justice examining NVIDIA's market dominance and proprietary CUDA software, alongside China's recent inquiries (as of late July/early August 2025) into potential "backdoors" in H20 chips. Competitive pressures are rising as rivals like Amazon offer aggressively priced AI chips (e.g., Inferentia and Trainium), and major cloud providers (e.g., Google, Microsoft, Amazon) develop in-house alternatives (e.g., Google TPUs, Microsoft Azure Maia, Amazon Trainium), potentially eroding NVIDIA's market share and affecting its high gross margins, which were 71.3% non-GAAP excluding the H20 charge in Q1 FY2026. Furthermore, NVIDIA's premium valuation, with a trailing twelve-month (TTM) P/E ratio of approximately 57.6 as of August 8, 2025, reflects high growth expectations, making it susceptible to significant corrections if growth decelerates or market sentiment shifts.
-
-# Summary of Key Takeaways:
-# *   Geopolitical tensions, particularly U.S.-China export restrictions, directly impact NVIDIA's revenue and gross margins, as seen with the $4.5 billion Q1 FY2026 charge (ended April 27, 2025) related to H20 chips and purchase obligations, and the projected $8.0 billion revenue loss in Q2 FY2026 from China.
-# *   Increased regulatory and antitrust scrutiny from multiple jurisdictions (U.S., France, China) presents legal and operational risks due to NVIDIA's market dominance and proprietary technology, including recent inquiries into potential "backdoors" in H20 chips.
-# *   Competitive pressures from existing rivals offering aggressively priced AI chips (e.g., Amazon Inferentia and Trainium) and large tech companies developing in-house AI chips (e.g., Google TPUs, Microsoft Azure Maia, Amazon Trainium) could lead to price wars and market share erosion, potentially impacting profitability.
-# *   NVIDIA's high valuation, with a trailing twelve-month (TTM) P/E ratio of approximately 57.6 as of August 8, 2025, indicates that its stock is priced for continued robust growth, making it vulnerable to market corrections if growth expectations are not met.
-# """
-
-                for topic_name, future in edit_futures.items():
-                    new_draft = future.result()
-                    sorted_results[topic_name] = new_draft
-                    # print(f"-> Edits for '{topic_name}' completed.")
-                    
-
-
-                count = count + 1
-
-            
-
-            
-
-            # print(f"\n--- Final Comprehensive Analysis for {company_name} ---")
-            for topic in Topic:
-                topic_label = topic.label
-                # Look up the analysis text from the dictionary using the correct label.
-                analysis_text = sorted_results.get(topic_label)
-
-                # Print a clear, differentiating header for each topic
-                print(f"\n\n{'='*70}")
-                print(f"TOPIC: {topic_label.upper()}")
-                print(f"{'='*70}\n")
-                
-                if analysis_text:
-                    # Apply formatting and print the analysis for the topic
-                    formatted_text = apply_ansi_formatting(analysis_text)
-                    print(formatted_text)
-                else:
-                    # This is a fallback in case a result for a topic was never generated.
-                    print("Analysis for this topic could not be found.")
 
+        print(f"\nGenerating a comprehensive analysis for {', '.join(company_names)}. This may take a few minutes...")
+        try:
+            if len(company_names) == 1:
+                sys.stdout.write(analyze_single_company(gemini_api_key, company_names[0]))
+                sys.stdout.flush()
+            else:
+                # Companies share llm_executor and the rate limiter; this pool only bounds how many
+                # pipelines are in flight. Reports print as each company finishes
+                company_futures = {
+                    company_executor.submit(analyze_single_company, gemini_api_key, name): name
+                    for name in company_names
+                }
+                for future in as_completed(company_futures):
+                    name = company_futures[future]
+                    try:
+                        report = future.result()
+                    except Exception as e:
+                        print(f"Error during company analysis for {name}: {str(e)}")
+                        continue
+                    sys.stdout.write(f"\n\n{'#'*70}\nCOMPANY: {name.upper()}\n{'#'*70}")
+                    sys.stdout.write(report)
+                    sys.stdout.flush()
 
             end_time = time.perf_counter()
             duration_seconds = end_time - start_time
@@ -561,6 +935,8 @@ def analyze_company(gemini_api_key: str, open_router_api_key: str):
             print(f"{'='*70}")
 
             print(f"\nRetries: {numOfRetries}")
+            print(f"Response cache: {llm_cache.stats['hits']} hits, {llm_cache.stats['misses']} misses")
+            print(f"Semantic cache: {semantic_cache.stats['hits']} hits, {semantic_cache.stats['misses']} misses")
 
 
         except Exception as e:
@@ -568,13 +944,12 @@ def analyze_company(gemini_api_key: str, open_router_api_key: str):
 
 def main():
     try:
-        gemini_api_key, open_router_api_key = setup_api()
-        analyze_company(gemini_api_key, open_router_api_key)
+        keys = setup_api()
+        analyze_company(keys.gemini_api_key, keys.open_router_api_key)
     except Exception as e:
         print(f"Fatal Error: {str(e)}")
         return 1
     return 0
 
 if __name__ == "__main__":
-    multiprocessing.freeze_support()
     exit(main());
\ No newline at end of file
@@ -0,0 +1,91 @@
+import hashlib
+import orjson
+from collections import OrderedDict
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+LLM_CACHE_FILE = "llm_cache.sqlite3"
+
+# Prompts embed today's date, so a day is the longest an entry can be useful anyway
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+# Sampling above this temperature is not deterministic enough to reuse a response
+MAX_CACHEABLE_TEMPERATURE = 0.2
+
+# Recently used entries are also kept in memory, so repeat hits skip the SQLite query
+MEMORY_CACHE_SIZE = 256
+
+stats = {"hits": 0, "misses": 0}
+
+_lock = threading.Lock()
+_conn = None
+_memory = OrderedDict()
+
+def _connection() -> sqlite3.Connection:
+    """Opens the cache database on first use. Callers must hold _lock."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(LLM_CACHE_FILE, check_same_thread=False)
+        _conn.execute("CREATE TABLE IF NOT EXISTS cache(key TEXT PRIMARY KEY, value BLOB, expires INTEGER)")
+        _conn.commit()
+    return _conn
+
+def cache_key(model_name: str, prompt: str, temperature: Optional[float]) -> Optional[str]:
+    """
+    Returns a sha256 key for an LLM call, or None if the call is too
+    nondeterministic to be cached.
+    """
+    if temperature is None or temperature > MAX_CACHEABLE_TEMPERATURE:
+        return None
+    payload = orjson.dumps({"model": model_name, "prompt": prompt, "temp": temperature}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+def _remember(key: str, value: str, expires: int):
+    """Adds an entry to the in-memory layer, evicting the least recently used. Callers must hold _lock."""
+    _memory[key] = (value, expires)
+    _memory.move_to_end(key)
+    if len(_memory) > MEMORY_CACHE_SIZE:
+        _memory.popitem(last=False)
+
+def get(key: str) -> Optional[str]:
+    """Returns the cached value for key, or None if it is missing or expired."""
+    with _lock:
+        now = int(time.time())
+        entry = _memory.get(key)
+        if entry is not None and entry[1] > now:
+            _memory.move_to_end(key)
+            stats["hits"] += 1
+            return entry[0]
+
+        row = _connection().execute(
+            "SELECT value, expires FROM cache WHERE key = ? AND expires > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            _memory.pop(key, None)
+            stats["misses"] += 1
+            return None
+        _remember(key, row[0], row[1])
+        stats["hits"] += 1
+        return row[0]
+
+def set(key: str, value: str, ttl: int = DEFAULT_TTL_SECONDS):
+    """Stores value under key for ttl seconds."""
+    with _lock:
+        expires = int(time.time()) + ttl
+        conn = _connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache(key, value, expires) VALUES (?, ?, ?)",
+            (key, value, expires)
+        )
+        conn.commit()
+        _remember(key, value, expires)
+
+def delete(key: str):
+    """Removes key from the cache, e.g. when its value turned out to be unusable."""
+    with _lock:
+        _memory.pop(key, None)
+        conn = _connection()
+        conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+        conn.commit()
@@ -0,0 +1,74 @@
+import orjson
+import os
+import threading
+import time
+from typing import Optional
+
+# Final analyses keyed by normalized company name and topic. Unlike llm_cache, a hit doesn't
+# need the same prompt, so "Apple Inc." reuses the report written for "apple". Different
+# names for one company (e.g. "Google" and "Alphabet") are separate entries
+SEMANTIC_CACHE_FILE = "semantic_cache.json"
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+stats = {"hits": 0, "misses": 0}
+
+_lock = threading.Lock()
+_entries = None
+
+def _load() -> list:
+    """Loads the cache file on first use and drops expired entries. Callers must hold _lock."""
+    global _entries
+    if _entries is None:
+        try:
+            with open(SEMANTIC_CACHE_FILE, "rb") as f:
+                _entries = orjson.loads(f.read())
+        except (IOError, ValueError):
+            _entries = []
+    now = time.time()
+    _entries = [entry for entry in _entries if entry["expires"] > now]
+    return _entries
+
+def _save():
+    """Writes the cache file atomically. Callers must hold _lock."""
+    tmp_path = SEMANTIC_CACHE_FILE + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(_entries))
+        os.replace(tmp_path, SEMANTIC_CACHE_FILE)
+    except IOError as e:
+        print(f"Error writing semantic cache file {SEMANTIC_CACHE_FILE}: {e}")
+
+def lookup(company_key: str, topic_label: str) -> Optional[str]:
+    """
+    Returns the cached analysis of topic_label for the company whose normalized name is
+    company_key, or None if there is none.
+    """
+    with _lock:
+        value = next(
+            (entry["value"] for entry in _load()
+             if entry.get("company_key") == company_key and entry["topic"] == topic_label),
+            None,
+        )
+        stats["hits" if value is not None else "misses"] += 1
+        return value
+
+def add_all(company_name: str, company_key: str, analyses: dict, ttl: int = DEFAULT_TTL_SECONDS):
+    """
+    Stores the final analyses of one company (topic label -> analysis) and writes the
+    cache file once for all of them.
+    """
+    if not analyses:
+        return
+    with _lock:
+        entries = _load()
+        expires = time.time() + ttl
+        for topic_label, value in analyses.items():
+            entries.append({
+                "company": company_name,
+                "company_key": company_key,
+                "topic": topic_label,
+                "value": value,
+                "expires": expires,
+            })
+        _save()